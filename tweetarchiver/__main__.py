@@ -1,9 +1,16 @@
+import csv
+import json
+import collections
 import time
 import shutil
 import logging
 import datetime
+import threading
 from pathlib import Path
+from urllib.parse import urlparse
 from argparse import ArgumentParser
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 
 import requests
 from sqlalchemy.orm import sessionmaker, Session
@@ -18,6 +25,8 @@ WORKING_DIR.mkdir(exist_ok=True)
 # I'm not really sure why that happens
 LOGGER = tweetarchiver.LOGGER
 
+EXPORT_FORMATS = ("csv", "jsonl")
+
 PARSER = ArgumentParser(
     prog="tweetarchiver",
     description="",
@@ -25,9 +34,15 @@ PARSER = ArgumentParser(
 )
 
 PARSER.add_argument("username",
-                    type=str, help="The account name whose tweets are to be archived")
+                    type=str, nargs="*", help="Names of the accounts whose tweets are to be archived")
+PARSER.add_argument("--accounts-file",
+                    type=Path, help="File with names of accounts to archive, one per line")
+PARSER.add_argument("--account-workers",
+                    type=int, default=2, help="Number of accounts archived at the same time, all of them share the same rate limits")
 PARSER.add_argument("--store-html",
-                    action="store_true", help="Store tweets in html form in separate table -- this increases database size dramatically")
+                    action="store_true", help="Store tweets in compressed html form in separate table -- this increases database size considerably")
+PARSER.add_argument("--compress-html",
+                    action="store_true", help="Compress html stored by older versions of tweetarchiver and reclaim the freed space")
 PARSER.add_argument("--skip-tests",
                     action="store_true", help="Do not perform initial scraper tests, which check whether scraping methods are up to date")
 PARSER.add_argument("--skip-tweets",
@@ -40,54 +55,120 @@ PARSER.add_argument("--skip-media",
                     action="store_true", help="Do not download videos or images")
 PARSER.add_argument("--skip-update",
                     action="store_true", help="Do not download tweets, videos or images")
+PARSER.add_argument("--prefetch",
+                    action="store_true", help="Download next page of search results while the current one is being processed")
+PARSER.add_argument("--shards",
+                    type=int, default=1, help="Split account's history into this many time windows and scrape them concurrently")
+PARSER.add_argument("--search-rate",
+                    type=float, default=1/1.5, help="Initial number of search requests per second, adjusted automatically based on server responses")
+PARSER.add_argument("--max-search-rate",
+                    type=float, default=2.0, help="Upper limit for the number of search requests per second")
+PARSER.add_argument("--parse-workers",
+                    type=int, default=0, help="Parse pages in this many worker processes, 0 to parse in the main process")
+PARSER.add_argument("--batch-size",
+                    type=int, default=500, help="Number of tweets inserted into the database in a single transaction")
+PARSER.add_argument("--card-workers",
+                    type=int, default=4, help="Number of card frames (polls, link previews) downloaded concurrently")
+PARSER.add_argument("--redirect-cache-ttl",
+                    type=int, default=90, help="Number of days after which cached t.co redirects are resolved again, 0 to disable the cache")
+PARSER.add_argument("--redirect-cache-size",
+                    type=int, default=200000, help="Maximum number of entries in the t.co redirect cache")
+PARSER.add_argument("--media-workers",
+                    type=int, default=4, help="Number of attachments downloaded concurrently")
+PARSER.add_argument("--segment-workers",
+                    type=int, default=4, help="Number of segments of a single video downloaded concurrently")
+PARSER.add_argument("--host-connections",
+                    type=int, default=4, help="Maximum number of concurrent connections to a single media host")
+PARSER.add_argument("--media-commit-every",
+                    type=int, default=100, help="Save progress of media downloads after this many attachments")
+PARSER.add_argument("--media-commit-interval",
+                    type=float, default=10.0, help="Save progress of media downloads at least every this many seconds")
+PARSER.add_argument("--html-parser",
+                    choices=tweetarchiver.HTML_PARSERS, default="html.parser", help="Html parser used for all scraped pages, lxml is considerably faster than the default")
+PARSER.add_argument("--db-profile",
+                    choices=list(tweetarchiver.SQLITE_PROFILES), default="default", help="Sqlite settings used for archive databases: 'safe' (rollback journal, fsync on every commit), 'default' (write-ahead log, allows reading the archive during updates), 'fast' (no fsync)")
+PARSER.add_argument("--reparse",
+                    action="store_true", help="Instead of updating the archive, rebuild tweets and attachments from html stored with --store-html, without accessing the network")
+PARSER.add_argument("--refresh",
+                    action="store_true", help="Instead of updating the archive, refresh reply, retweet and like counts of recent tweets and results of open polls")
+PARSER.add_argument("--refresh-age",
+                    type=int, default=30, metavar="DAYS", help="Refresh counts of tweets posted in the last DAYS days, younger tweets are refreshed more often")
+PARSER.add_argument("--refresh-limit",
+                    type=int, default=0, metavar="N", help="Refresh at most N tweets, the most overdue ones first")
+HTTP_ARCHIVE_ARGS = PARSER.add_mutually_exclusive_group()
+HTTP_ARCHIVE_ARGS.add_argument("--record",
+                               type=Path, metavar="PATH", help="Save all received responses to http archive at PATH")
+HTTP_ARCHIVE_ARGS.add_argument("--replay",
+                               type=Path, metavar="PATH", help="Do not access the network, serve all requests from http archive at PATH created with --record")
 PARSER.add_argument("--export",
-                    type=Path, help="Export database contents to a csv file")
+                    type=Path, help="Export database contents to a csv or json lines file")
+PARSER.add_argument("--export-format",
+                    choices=EXPORT_FORMATS, help="Format of exported file, by default it is guessed from file extension (.jsonl for json lines, csv otherwise)")
+PARSER.add_argument("--since",
+                    type=int, default=0, metavar="TWEET_ID", help="Only export tweets newer than this tweet id")
+PARSER.add_argument("--until",
+                    type=int, default=0, metavar="TWEET_ID", help="Only export tweets up to and including this tweet id")
 PARSER.add_argument("-v", "--version",
                     action="version", version="%(prog)s {}".format(tweetarchiver.__VERSION__))
 
 
-def update_tweets(username: str, db_session: Session, store_html: bool = False) -> int:
-    newest_id = tweetarchiver.Tweet.newest_tweet(db_session)
-    oldest_id = tweetarchiver.Tweet.oldest_tweet(db_session)
-    attachment_rows = 0
-    tweet_rows = 0
-    start_time = time.time()
-    options = []
-    if newest_id:
-        # only get tweets older than what's already in db
-        options.append({"max_id":oldest_id})
-    if oldest_id:
-        # only get newer stuff
-        options.append({"min_id":newest_id})
-    if not options:
-        # get it all
-        options = [{}]
-
-    for kwargs in options:
-        for html_page in tweetarchiver.scrape_tweets(username, **kwargs):
-            timestamp = int(time.time())
-            attachments = []
-            tweets_html = []
-            tweets_parsed = []
+def update_tweets(username: str, db_session: Session, store_html: bool = False,
+                  prefetch: bool = False, card_workers: int = 4,
+                  shards: int = 1, parse_workers: int = 0, batch_size: int = 500) -> int:
+    """Scrape all ranges of tweet ids which were not scraped yet (see
+    tweetarchiver.ScrapedRange), newest first. Ranges are marked as scraped
+    page by page, together with their tweets, so interrupted or aborted runs
+    are resumed exactly where they stopped. Archives created before ranges
+    were recorded are assumed to be complete between their oldest and
+    newest tweet.
 
-            for html in html_page:
-                if store_html:
-                    tweets_html.append(tweetarchiver.TweetHTML(html, timestamp))
+    With shards > 1, each range is split into windows scraped concurrently
+    (see tweetarchiver.scrape_tweets_sharded).
 
-                tweet_parsed = tweetarchiver.Tweet.from_html(html)
-                if tweet_parsed.has_video or tweet_parsed.image_count:
-                    attachments.extend(tweetarchiver.Attachment.from_html(html))
+    With parse_workers > 0, pages are parsed by that many worker processes
+    (see tweetarchiver.parse_pages) and only written to the database here,
+    in the order in which they were scraped.
 
-                tweets_parsed.append(tweet_parsed)
+    Rows are inserted in batches of batch_size tweets, tweets which are
+    already archived are skipped (see tweetarchiver.BulkWriter).
+    """
+    start_time = time.time()
+    if not db_session.query(tweetarchiver.ScrapedRange).first():
+        newest_id = tweetarchiver.Tweet.newest_tweet(db_session)
+        oldest_id = tweetarchiver.Tweet.oldest_tweet(db_session)
+        if newest_id:
+            LOGGER.info("Assuming tweets between %s and %s were already scraped", oldest_id, newest_id)
+            tweetarchiver.ScrapedRange.add(db_session, oldest_id, newest_id)
+            db_session.commit()
 
-            db_session.add_all(tweets_html)
-            db_session.add_all(tweets_parsed)
-            db_session.add_all(attachments)
+    upper_id = tweetarchiver.timestamp_to_snowflake(start_time)
+    options = []
+    for gap_min, gap_max in tweetarchiver.ScrapedRange.gaps(db_session, 0, upper_id):
+        # scrape_tweets excludes both min_id and max_id, 0 means unbounded
+        options.append({"min_id": max(gap_min - 1, 0), "max_id": 0 if gap_max >= upper_id else gap_max + 1})
+    LOGGER.info("Scraping %s ranges of ids", len(options))
 
-            db_session.commit()
-            tweet_rows += len(tweets_parsed)
-            attachment_rows += len(attachments)
+    writer = tweetarchiver.BulkWriter(db_session, batch_size=batch_size)
+    try:
+        for kwargs in options:
+            for tweets_parsed, attachments, tweets_html, bounds in _parsed_pages(
+                    username, kwargs, store_html, prefetch, shards, parse_workers):
+                tweetarchiver.resolve_cards(tweets_parsed, max_workers=card_workers)
+                writer.add([tweet.to_record() for tweet in tweets_parsed],
+                           [attachment.to_record() for attachment in attachments],
+                           [tweet_html.to_record() for tweet_html in tweets_html],
+                           scraped_range=bounds)
+            writer.flush()
+    except BaseException as exc:
+        if not isinstance(exc, tweetarchiver.sqla.exc.SQLAlchemyError):
+            # every buffered page is complete, keep them
+            writer.flush()
+        raise
 
+    tweet_rows = writer.tweet_rows
+    attachment_rows = writer.attachment_rows
+    if writer.skipped_rows:
+        LOGGER.info("Skipped %s tweets which were already archived", writer.skipped_rows)
     time_str = str(datetime.timedelta(seconds=time.time() - start_time))
     LOGGER.info("Inserted %s new tweet rows", tweet_rows)
     LOGGER.info("Inserted %s new attachment rows", attachment_rows)
@@ -95,95 +176,452 @@ def update_tweets(username: str, db_session: Session, store_html: bool = False)
     return attachment_rows + tweet_rows
 
 
+def _parsed_pages(username: str, query: dict, store_html: bool, prefetch: bool,
+                  shards: int, parse_workers: int) -> Iterator[tuple]:
+    """Yield (tweets, attachments, tweets_html, bounds) for every scraped page,
+    bounds being the range of ids covered by the page (see tweetarchiver.page_bounds).
+    """
+    if parse_workers:
+        if shards > 1:
+            pages = tweetarchiver.scrape_tweets_sharded(
+                username, shards=shards, prefetch=prefetch, raw=True, with_bounds=True,
+                close_session=False, **query)
+        else:
+            pages = tweetarchiver.scrape_pages(
+                username, prefetch=prefetch, with_bounds=True, close_session=False, **query)
+
+        # parse_pages keeps the order of pages, bounds are matched with them on the way out
+        page_bounds: collections.deque = collections.deque()
+        def page_html() -> Iterator[str]:
+            for html, bounds in pages:
+                page_bounds.append(bounds)
+                yield html
+
+        for page in tweetarchiver.parse_pages(page_html(), workers=parse_workers, keep_html=store_html):
+            timestamp = int(time.time())
+            yield ([tweetarchiver.Tweet.from_record(record) for record in page.tweets],
+                   [tweetarchiver.Attachment.from_record(record) for record in page.attachments],
+                   [tweetarchiver.TweetHTML(html, timestamp, tweet_id) for tweet_id, html in page.html],
+                   page_bounds.popleft())
+        return
+
+    if shards > 1:
+        pages = tweetarchiver.scrape_tweets_sharded(
+            username, shards=shards, prefetch=prefetch, with_bounds=True, close_session=False, **query)
+    else:
+        pages = tweetarchiver.scrape_tweets(
+            username, prefetch=prefetch, with_bounds=True, close_session=False, **query)
+
+    for html_page, bounds in pages:
+        timestamp = int(time.time())
+        attachments = []
+        tweets_html = []
+        tweets_parsed = []
+
+        for html in html_page:
+            if store_html:
+                tweets_html.append(tweetarchiver.TweetHTML(html, timestamp))
+
+            tweet_parsed, tweet_attachments = tweetarchiver.parse_tweet(html, resolve_cards=False)
+            attachments.extend(tweet_attachments)
+            tweets_parsed.append(tweet_parsed)
+
+        yield tweets_parsed, attachments, tweets_html, bounds
+
+
+class HostSlots:
+    """Limit the number of concurrent connections to a single host."""
+    def __init__(self, per_host: int) -> None:
+        self.per_host = per_host
+        self._slots: Dict[str, threading.Semaphore] = {}
+        self._lock = threading.Lock()
+
+
+    def __call__(self, url: str) -> threading.Semaphore:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.Semaphore(self.per_host)
+            return self._slots[host]
+
+
+class ImageVariants:
+    """Learn which size variants (url suffixes) of images are served,
+    separately for each media host, directory and file extension.
+
+    Every variant keeps a moving average of how often it was found. The most
+    preferred variant which is usually found is downloaded straight away,
+    with less preferred variants as fallbacks. Better variants which were
+    rarely found after give_up_after attempts are skipped, and probed again
+    every reprobe_after images so that a pattern can recover. Variants with
+    too few or mixed results are probed with a HEAD request before being
+    downloaded.
+    Can be shared between threads.
+    """
+    # in order of preference
+    SUFFIXES = (":orig", ":large", "")
+    # weight of the latest result in the moving average
+    SMOOTHING = 0.25
+    # variants found less often than this are skipped
+    SKIP_BELOW = 0.1
+
+    def __init__(self, give_up_after: int = 3, reprobe_after: int = 50) -> None:
+        self.give_up_after = give_up_after
+        self.reprobe_after = reprobe_after
+        self.skipped = 0
+        # pattern -> suffix -> [found rate, attempts, skipped since last attempt]
+        self._results: Dict[tuple, Dict[str, list]] = {}
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def pattern(url: str) -> Tuple[str, str, str]:
+        parsed_url = urlparse(url)
+        directory, _, filename = parsed_url.path.rpartition("/")
+        return parsed_url.netloc, directory, filename.rpartition(".")[2]
+
+
+    def candidates(self, url: str) -> List[Tuple[str, bool]]:
+        """Return (suffix, probe first) for every variant of url worth trying."""
+        candidates = []
+        with self._lock:
+            results = self._results.get(self.pattern(url), {})
+            for suffix in self.SUFFIXES:
+                if suffix not in results:
+                    candidates.append((suffix, False))
+                    continue
+
+                result = results[suffix]
+                found_rate, attempts, skipped = result
+                if found_rate >= 0.5:
+                    candidates.append((suffix, False))
+                    continue
+
+                if attempts >= self.give_up_after and found_rate < self.SKIP_BELOW:
+                    if skipped < self.reprobe_after:
+                        result[2] += 1
+                        self.skipped += 1
+                        continue
+                    # give it another chance, the counter is reset by record()
+                    LOGGER.debug("Probing %s variant of %s again", suffix or "plain", url)
+                candidates.append((suffix, True))
+
+        if not candidates:
+            # nothing has ever worked for this pattern, try everything again
+            return [(suffix, False) for suffix in self.SUFFIXES]
+
+        # there is nothing left to fall back to after the last variant
+        candidates[-1] = (candidates[-1][0], False)
+        return candidates
+
+
+    def record(self, url: str, suffix: str, found: bool) -> None:
+        with self._lock:
+            results = self._results.setdefault(self.pattern(url), {})
+            if suffix not in results:
+                results[suffix] = [float(found), 1, 0]
+                return
+
+            result = results[suffix]
+            result[0] += self.SMOOTHING * (found - result[0])
+            result[1] += 1
+            result[2] = 0
+
+
+def fetch_attachment(url: str, media_type: str, temp_file: Path,
+                     host_slots: HostSlots, segment_workers: int = 4,
+                     image_variants: Optional[ImageVariants] = None) -> Optional[tweetarchiver.Response]:
+    """Download attachment to temp_file, trying all known variants of the url,
+    in the order suggested by image_variants.
+    Meant to be run in worker threads - does not touch the database.
+
+    Partial downloads left in temp_file by an interrupted run are resumed.
+    Videos are downloaded from their playlists, segment_workers segments at a time.
+
+    Return Response or None if none of the variants could be found.
+    """
+    if media_type == "vid:mp4":
+        return fetch_video(url, temp_file, host_slots, segment_workers)
+
+    if not media_type.startswith("img"):
+        candidates = [("", False)]
+        image_variants = None
+    elif image_variants:
+        candidates = image_variants.candidates(url)
+    else:
+        candidates = [(suffix, False) for suffix in ImageVariants.SUFFIXES]
+
+    progress = tweetarchiver.PartialDownload.progress(temp_file)
+    if progress and progress["url"].startswith(url):
+        # start with the variant which was being downloaded
+        candidates.sort(key=lambda candidate: f"{url}{candidate[0]}" != progress["url"])
+
+    with host_slots(url):
+        for suffix, probe in candidates:
+            try:
+                if probe:
+                    tweetarchiver.download(f"{url}{suffix}", method="HEAD").response.close()
+                LOGGER.info("Downloading %s", temp_file.name)
+                file_download = tweetarchiver.download_resumable(f"{url}{suffix}", temp_file)
+            except requests.HTTPError as err:
+                if err.response.status_code == 404:
+                    # continue down the suffix list
+                    if image_variants:
+                        image_variants.record(url, suffix, found=False)
+                else:
+                    print(f"Could not complete download due to HTTP error: {str(err)}")
+                    raise
+            except requests.RequestException as exc:
+                print(f"Could not complete download due to network error: {str(exc)}")
+                raise
+            else:
+                if image_variants:
+                    image_variants.record(url, suffix, found=True)
+                return file_download
+
+    return None
+
+
+def fetch_video(url: str, temp_file: Path, host_slots: HostSlots,
+                segment_workers: int = 4) -> Optional[tweetarchiver.Response]:
+    """Download video of the tweet at url to temp_file.
+    Return Response or None if the video is not available.
+    """
+    tweet_id = int(url.rstrip("/").rsplit("/", maxsplit=1)[-1])
+    with host_slots(url), temp_file.open(mode="wb") as download_destination:
+        LOGGER.info("Downloading video from tweet %s", tweet_id)
+        try:
+            return tweetarchiver.download_video(tweet_id, download_destination, workers=segment_workers)
+        except requests.HTTPError as err:
+            if err.response.status_code in (403, 404):
+                # removed, or not available without logging in
+                download_destination.close()
+                temp_file.unlink()
+                return None
+            print(f"Could not complete download due to HTTP error: {str(err)}")
+            raise
+        except requests.RequestException as exc:
+            print(f"Could not complete download due to network error: {str(exc)}")
+            raise
+
+
 # decide the structure:
 # one db per account, displaying full threads requires joining dbs
 # one db per main account, context tweets from other accounts stored alongside
 #
-def update_media(db_session: Session, archive_dir: Path) -> int:
+def update_media(db_session: Session, archive_dir: Path, workers: int = 4, per_host: int = 4,
+                 commit_every: int = 100, commit_interval: float = 10.0,
+                 host_slots: Optional[HostSlots] = None, segment_workers: int = 4,
+                 image_variants: Optional[ImageVariants] = None,
+                 skip_images: bool = False, skip_videos: bool = False) -> int:
+    """Download missing attachments using up to workers threads, with at most
+    per_host concurrent connections to a single host, or as many as allowed
+    by host_slots shared with other calls. All database updates are done
+    from the calling thread. Image variants which are not served are learned
+    by image_variants, which can also be shared between calls.
+
+    Files are kept in a content-addressed store (see Attachment.store_path).
+    Urls which were already downloaded are not fetched again, and files with
+    known hashes are referenced instead of being stored twice.
+
+    Attachments are read from the database in batches, as downloads finish.
+    Changes are committed every commit_every attachments or commit_interval
+    seconds, whichever comes first - interrupted runs are resumed from the
+    first uncommitted attachment, files already moved to the store are not
+    moved twice.
+
+    Images (img:*) and videos (vid:*, including gifs) are left out with
+    skip_images and skip_videos.
+    """
     LOGGER.debug("Starting update_media")
     dirs = {
         "attachments" : archive_dir / "attachments",
-        "attachments/gifs" : archive_dir / "attachments" / "gif",
-        "attachments/imgs" : archive_dir / "attachments" / "img",
-        "attachments/vids" : archive_dir / "attachments" / "vid",
+        "attachments/objects" : archive_dir / "attachments" / "objects",
         "tmp" : archive_dir / "tmp",
     }
 
     for path in dirs.values():
         path.mkdir(exist_ok=True)
 
+    def reference(attachment: tweetarchiver.Attachment, known_file) -> None:
+        attachment.size = known_file.size
+        attachment.hash = known_file.hash
+        attachment.path = known_file.path
+
     downloaded = 0
     duplicates = 0
-    for attachment in tweetarchiver.Attachment.with_missing_files(db_session):
-        if attachment.type == "vid:mp4":
-            LOGGER.warning("VIDEO DOWNLOAD NOT YET IMPLEMENTED, SKIPPING")
-            continue
-
-        filename = attachment.url.rsplit("/", maxsplit=1)[-1]
-        temp_file = dirs["tmp"] / filename
-
-        if attachment.type.startswith("img"):
-            suffixes = [":orig", ":large", ""]
-        else:
-            suffixes = [""]
-
-        file_download = None
-        for suffix in suffixes:
-            with temp_file.open(mode="wb") as download_destination:
-                LOGGER.info("Downloading %s", filename)
-                try:
-                    file_download = tweetarchiver.download(
-                        f"{attachment.url}{suffix}", to_file=download_destination)
-                    break
-                except requests.HTTPError as err:
-                    if err.response.status_code == 404:
-                        # continue down the suffix list
-                        pass
-                    else:
-                        print(f"Could not complete download due to HTTP error: {str(err)}")
-                        raise
-                except requests.RequestException as exc:
-                    print(f"Could not complete download due to network error: {str(exc)}")
-                    raise
-
-        if not file_download:
-            LOGGER.error("DOWNLOAD FAILED FOR URL:%s", attachment.url)
-            continue
-
-        matching_hash_query = db_session.query(tweetarchiver.Attachment).filter(tweetarchiver.Attachment.hash == file_download.hash)
-        known_file = matching_hash_query.first()
-        if known_file:
-            duplicates += 1
-            LOGGER.debug("Duplicate file found")
-            LOGGER.debug("known url:%s, duplicate url:%s, hash:%s", known_file.url, attachment.url, file_download.hash)
-            assert known_file.size == file_download.size
-            attachment.size = known_file.size
-            attachment.hash = known_file.hash
-            attachment.path = known_file.path
-            temp_file.unlink()
-        else:
-            downloaded += 1
-            if attachment.type.startswith("img"):
-                final_file_path = dirs["attachments/imgs"] / filename
-            elif attachment.type == "vid:gif":
-                final_file_path = dirs["attachments/gifs"] / filename
+    known_urls = 0
+    uncommitted = 0
+    last_commit = time.time()
+    host_slots = host_slots or HostSlots(per_host)
+    image_variants = image_variants or ImageVariants()
+    # future -> (url, temp file, file name or None for videos, attachments sharing the url)
+    pending: Dict[Future, tuple] = {}
+    pending_urls: Dict[str, Future] = {}
+    max_pending = workers * 4
+    skipped_types = tuple(prefix for prefix, skip in (("img:", skip_images), ("vid:", skip_videos)) if skip)
+    skipped = 0
+
+    def commit(force: bool = False) -> None:
+        nonlocal uncommitted, last_commit
+        if uncommitted and (force or uncommitted >= commit_every or time.time() - last_commit >= commit_interval):
+            LOGGER.debug("Committing %s attachments", uncommitted)
+            db_session.commit()
+            uncommitted = 0
+            last_commit = time.time()
+
+    def finish(done: Iterable[Future]) -> None:
+        nonlocal downloaded, duplicates, known_urls, uncommitted
+        for future in done:
+            url, temp_file, filename, attachments = pending.pop(future)
+            del pending_urls[url]
+            file_download = future.result()
+            if not file_download:
+                LOGGER.error("DOWNLOAD FAILED FOR URL:%s", url)
+                continue
+
+            if not filename:
+                # videos are named after their first segment, which tells the container format
+                filename = urlparse(file_download.response.url).path.rsplit("/", maxsplit=1)[-1]
+
+            known_file = tweetarchiver.Attachment.known_hash(db_session, file_download.hash)
+            if known_file:
+                duplicates += 1
+                LOGGER.debug("Duplicate file found")
+                LOGGER.debug("known url:%s, duplicate url:%s, hash:%s", known_file.url, url, file_download.hash)
+                assert known_file.size == file_download.size
+                store_path = known_file.path
+                temp_file.unlink()
             else:
-                final_file_path = dirs["attachments/vids"] / filename
-
-            shutil.move(temp_file, final_file_path)
-            attachment.size = file_download.size
-            attachment.hash = file_download.hash
-            attachment.path = str(final_file_path.relative_to(archive_dir))
-
-        db_session.commit()
+                downloaded += 1
+                store_path = tweetarchiver.Attachment.store_path(file_download.hash, filename)
+                final_file_path = archive_dir / store_path
+                final_file_path.parent.mkdir(exist_ok=True)
+                if final_file_path.exists():
+                    # left over from an interrupted run
+                    temp_file.unlink()
+                else:
+                    shutil.move(temp_file, final_file_path)
+
+            known_urls += len(attachments) - 1
+            for attachment in attachments:
+                attachment.size = file_download.size
+                attachment.hash = file_download.hash
+                attachment.path = store_path
+            uncommitted += len(attachments)
+            commit()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for batch in tweetarchiver.Attachment.with_missing_files(db_session, batch_size=max(commit_every, max_pending)):
+                # group commits expire loaded objects, read everything needed beforehand
+                batch = [(attachment, attachment.id, attachment.url, attachment.type) for attachment in batch]
+                for attachment, attachment_id, url, media_type in batch:
+                    if skipped_types and media_type.startswith(skipped_types):
+                        skipped += 1
+                        continue
+
+                    if url in pending_urls:
+                        # same url is already being downloaded
+                        pending[pending_urls[url]][3].append(attachment)
+                        continue
+
+                    known_file = tweetarchiver.Attachment.known_url(db_session, url)
+                    if known_file:
+                        LOGGER.debug("Url already downloaded: %s", url)
+                        known_urls += 1
+                        reference(attachment, known_file)
+                        uncommitted += 1
+                        commit()
+                        continue
+
+                    filename = url.rsplit("/", maxsplit=1)[-1]
+                    # attachment id keeps temp files unique
+                    temp_file = dirs["tmp"] / f"{attachment_id}_{filename}"
+                    if media_type == "vid:mp4":
+                        filename = None
+                    future = executor.submit(fetch_attachment, url, media_type, temp_file, host_slots,
+                                             segment_workers, image_variants)
+                    pending[future] = (url, temp_file, filename, [attachment])
+                    pending_urls[url] = future
+                    while len(pending) >= max_pending:
+                        finish(wait(pending, return_when=FIRST_COMPLETED).done)
+
+            while pending:
+                finish(wait(pending, return_when=FIRST_COMPLETED).done)
+            commit(force=True)
+        except BaseException as exc:
+            # do not start any more downloads, finish the ones in progress
+            for future in pending:
+                future.cancel()
+            if not isinstance(exc, tweetarchiver.sqla.exc.SQLAlchemyError):
+                # keep the progress made so far
+                commit(force=True)
+            raise
 
     LOGGER.info("Downloaded %s new attachments", downloaded)
     print(f"Downloaded {downloaded} new attachments")
     LOGGER.info("Skipped %s attachments with matching hashes", duplicates)
     print(f"Skipped {duplicates} attachments with matching hashes")
+    LOGGER.info("Skipped %s attachments with already downloaded urls", known_urls)
+    print(f"Skipped {known_urls} attachments with already downloaded urls")
+    if skipped:
+        LOGGER.info("Skipped %s attachments of excluded types", skipped)
+        print(f"Skipped {skipped} attachments of excluded types")
+    LOGGER.debug("Skipped %s requests for image variants which are not served", image_variants.skipped)
     return downloaded
 
 
+def reparse(db_session: Session, workers: int = 0, batch_size: int = 500) -> int:
+    """Rebuild tweets from stored html and print a summary of changes."""
+    LOGGER.debug("Starting reparse")
+    start_time = time.time()
+    stats = tweetarchiver.reparse_archive(db_session, workers=workers, batch_size=batch_size)
+    run_time = time.time() - start_time
+    LOGGER.info("Reparsed %s tweets in %.1fs", stats["tweets"], run_time)
+    print(f"Reparsed {stats['tweets']} tweets in {run_time:.1f}s")
+    print(f"{stats['updated']} tweets changed, {stats['inserted']} tweets added")
+    if stats["missing_cards"]:
+        print(f"{stats['missing_cards']} cards could not be parsed offline, their data was kept")
+
+    summary = {key: count for key, count in stats.items()
+               if key not in ("tweets", "updated", "inserted", "missing_cards")}
+    for column, count in sorted(summary.items(), key=lambda item: -item[1]):
+        LOGGER.info("Changed %s: %s", column, count)
+        print(f"    {column}: {count} changed")
+
+    return stats["updated"] + stats["inserted"]
+
+
+def refresh(username: str, db_session: Session, max_age: int = tweetarchiver.REFRESH_MAX_AGE,
+            limit: int = 0, card_workers: int = 4) -> int:
+    """Refresh counters of recent tweets and open polls and print a summary."""
+    LOGGER.debug("Starting refresh")
+    start_time = time.time()
+    stats = tweetarchiver.refresh_archive(db_session, username, max_age=max_age,
+                                          limit=limit, card_workers=card_workers)
+    run_time = time.time() - start_time
+    LOGGER.info("Refreshed %s tweets and %s polls in %.1fs", stats["tweets"], stats["polls"], run_time)
+    print(f"Refreshed {stats['tweets']} tweets and {stats['polls']} polls in {run_time:.1f}s")
+    print(f"{stats['changed']} tweets changed")
+    if stats["missing"]:
+        print(f"{stats['missing']} tweets could not be found, they may have been deleted")
+    return stats["changed"]
+
+
+def compress_html(db_session: Session) -> int:
+    print("Compressing stored html...", end="", flush=True)
+    compressed = tweetarchiver.compress_stored_html(db_session)
+    print("Done!")
+    LOGGER.info("Compressed html of %s tweets", compressed)
+    if compressed:
+        print("Reclaiming free space...", end="", flush=True)
+        db_session.execute("VACUUM")
+        print("Done!")
+
+    return compressed
+
+
 def scraper_test() -> bool:
     print("Performing parser test on live data...", end="", flush=True)
     test_live.livetest()
@@ -195,43 +633,186 @@ def full_test() -> bool:
     pass
 
 
-def export(session: Session) -> str:
-    pass
+# attachment columns included in exports
+EXPORT_ATTACHMENT_COLUMNS = ("position", "type", "url", "sensitive", "size", "hash", "path")
+
+
+def export(session: Session, export_path: Path, export_format: Optional[str] = None,
+           since_id: int = 0, max_id: int = 0) -> int:
+    """Write archived tweets to export_path as csv or json lines,
+    streaming them from the database in chunks.
+
+    If export_format is not given, it is guessed from file extension.
+    In csv files, poll data and attachments are json-encoded.
+    Return number of exported tweets.
+    """
+    if not export_format:
+        export_format = "jsonl" if export_path.suffix.lower() in (".jsonl", ".json") else "csv"
+
+    LOGGER.info("Exporting tweets to %s", export_path)
+    print(f"Exporting tweets to {export_path}...", end="", flush=True)
+    exported = 0
+    with export_path.open(mode="w", encoding="utf-8", newline="") as export_file:
+        if export_format == "csv":
+            fieldnames = [column.name for column in tweetarchiver.Tweet.__table__.columns] + ["attachments"]
+            writer = csv.DictWriter(export_file, fieldnames=fieldnames)
+            writer.writeheader()
+
+        for tweet, attachments in tweetarchiver.iter_archive(session, since_id, max_id):
+            tweet["attachments"] = [
+                {name: attachment[name] for name in EXPORT_ATTACHMENT_COLUMNS} for attachment in attachments
+            ]
+            if export_format == "csv":
+                tweet["poll_data"] = json.dumps(tweet["poll_data"]) if tweet["poll_data"] else None
+                tweet["attachments"] = json.dumps(tweet["attachments"]) if attachments else None
+                writer.writerow(tweet)
+            else:
+                export_file.write(json.dumps(tweet, ensure_ascii=False))
+                export_file.write("\n")
+            exported += 1
 
+    print("Done!")
+    LOGGER.info("Exported %s tweets", exported)
+    print(f"Exported {exported} tweets")
+    return exported
 
-def main() -> None:
-    args = PARSER.parse_args()
 
-    if not args.skip_tests:
-        scraper_test()
-
-    username = args.username.lower()
+def archive_account(username: str, args, host_slots: HostSlots,
+                    image_variants: Optional[ImageVariants] = None) -> None:
+    """Run all tasks selected by command line arguments for a single account.
+    Can be called for different accounts from multiple threads at once.
+    """
     dbpath = WORKING_DIR / username
     dbpath.mkdir(exist_ok=True)
     dbfile = dbpath / f"{username}_twitter_archive.sqlite"
-    dbexists = Path(dbpath).exists()
 
-    sqla_engine = tweetarchiver.sqla.create_engine(f"sqlite:///{str(dbfile)}", echo=False)
-    tweetarchiver.DeclarativeBase.metadata.create_all(sqla_engine)
+    sqla_engine = tweetarchiver.create_archive_engine(dbfile, args.db_profile)
+    tweetarchiver.migrate_schema(sqla_engine)
     bound_session = sessionmaker(bind=sqla_engine)
-    LOGGER.info("Creating new db session")
+    LOGGER.info("Creating new db session for %s", username)
     session = bound_session()
 
     try:
-        if not args.skip_update:
+        if args.reparse:
+            reparse(session, workers=args.parse_workers, batch_size=args.batch_size)
+        elif args.refresh:
+            refresh(username, session, max_age=args.refresh_age * 24 * 60 * 60,
+                    limit=args.refresh_limit, card_workers=args.card_workers)
+        elif not args.skip_update:
             if not args.skip_tweets:
-                update_tweets(username, session)
+                update_tweets(username, session, store_html=args.store_html,
+                              prefetch=args.prefetch, card_workers=args.card_workers,
+                              shards=args.shards, parse_workers=args.parse_workers,
+                              batch_size=args.batch_size)
             if not args.skip_media:
-                update_media(session, dbpath)
+                update_media(session, dbpath, workers=args.media_workers, host_slots=host_slots,
+                             commit_every=args.media_commit_every, commit_interval=args.media_commit_interval,
+                             segment_workers=args.segment_workers, image_variants=image_variants,
+                             skip_images=args.skip_images, skip_videos=args.skip_videos)
+        if args.compress_html:
+            compress_html(session)
         if args.export:
-            export(session)
+            export_path = args.export
+            if len(args.username) > 1:
+                export_path = export_path.with_name(f"{username}_{export_path.name}")
+            export(session, export_path, args.export_format, since_id=args.since, max_id=args.until)
     except:
-        LOGGER.error("Uncaught exception, rolling back db session")
+        LOGGER.error("Uncaught exception, rolling back db session of %s", username)
         session.rollback()
         raise
     finally:
-        LOGGER.info("Closing db session")
+        LOGGER.info("Closing db session of %s", username)
         session.close()
+        sqla_engine.dispose()
+
+
+def read_accounts(accounts_file: Path) -> List[str]:
+    """Return account names listed in accounts_file, one per line.
+    Empty lines and lines starting with # are ignored.
+    """
+    accounts = []
+    with accounts_file.open(encoding="utf-8") as lines:
+        for line in lines:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                accounts.append(line.lstrip("@"))
+    return accounts
+
+
+def main() -> None:
+    args = PARSER.parse_args()
+    try:
+        tweetarchiver.set_html_parser(args.html_parser)
+    except ValueError as exc:
+        PARSER.error(str(exc))
+
+    if args.accounts_file:
+        try:
+            args.username.extend(read_accounts(args.accounts_file))
+        except OSError as exc:
+            PARSER.error(f"Could not read accounts file: {exc}")
+    # remove duplicates, keep order
+    args.username = list(dict.fromkeys(username.lower() for username in args.username))
+    if not args.username:
+        PARSER.error("no accounts given")
+
+    if args.record or args.replay:
+        try:
+            tweetarchiver.HTTP_ARCHIVE = tweetarchiver.HTTPArchive(
+                args.record or args.replay, replay=bool(args.replay))
+        except FileNotFoundError as exc:
+            PARSER.error(str(exc))
+
+    if not args.skip_tests and not args.reparse:
+        scraper_test()
+
+    # everything below is shared between all archived accounts
+    tweetarchiver.RATE_LIMITER.set_rate("search", args.search_rate, args.max_search_rate)
+    account_workers = min(args.account_workers, len(args.username))
+    tweetarchiver.set_connection_pool_size(
+        account_workers * max(args.card_workers, args.media_workers * args.segment_workers, args.shards))
+    host_slots = HostSlots(args.host_connections)
+    image_variants = ImageVariants()
+
+    if args.redirect_cache_ttl > 0:
+        tweetarchiver.REDIRECT_CACHE = tweetarchiver.RedirectCache(
+            WORKING_DIR / "redirect_cache.sqlite",
+            ttl=args.redirect_cache_ttl * 24 * 60 * 60,
+            max_entries=args.redirect_cache_size,
+            profile=args.db_profile)
+
+    try:
+        if len(args.username) == 1:
+            archive_account(args.username[0], args, host_slots, image_variants)
+            return
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=account_workers) as executor:
+            accounts = {executor.submit(archive_account, username, args, host_slots, image_variants): username
+                        for username in args.username}
+            try:
+                for future in as_completed(accounts):
+                    username = accounts[future]
+                    if future.exception():
+                        LOGGER.error("Archiving %s failed", username, exc_info=future.exception())
+                        failed.append(username)
+                    else:
+                        LOGGER.info("Finished archiving %s", username)
+                        print(f"Finished archiving {username}")
+            except:
+                # do not start any more accounts, finish the ones in progress
+                for future in accounts:
+                    future.cancel()
+                raise
+
+        print(f"Archived {len(args.username) - len(failed)} of {len(args.username)} accounts")
+        if failed:
+            raise RuntimeError(f"Archiving failed for {len(failed)} accounts: {', '.join(failed)}")
+    finally:
+        if tweetarchiver.REDIRECT_CACHE:
+            tweetarchiver.REDIRECT_CACHE.close()
+        if tweetarchiver.HTTP_ARCHIVE:
+            tweetarchiver.HTTP_ARCHIVE.close()
 
 
 if __name__ == "__main__":
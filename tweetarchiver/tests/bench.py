@@ -0,0 +1,243 @@
+"""Offline throughput benchmarks of parsing, the scraping loop, database
+writes and media downloads.
+
+Requests are served by a local stand-in for twitter, from the synthetic
+corpus of search pages and card frames in tests/corpus. Results are
+printed as json; with --baseline, the run fails if any throughput dropped
+by more than --threshold compared to the results in the baseline file,
+which should come from an earlier run on the same machine.
+
+usage: python -m tweetarchiver.tests.bench [--output results.json] [--baseline baseline.json]
+"""
+import io
+import re
+import sys
+import json
+import time
+import logging
+import platform
+import tempfile
+import contextlib
+from pathlib import Path
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse, parse_qs
+from argparse import ArgumentParser
+
+import requests
+from requests.adapters import BaseAdapter
+from sqlalchemy.orm import sessionmaker
+
+import tweetarchiver
+from tweetarchiver import __main__ as cli
+
+LOGGER = logging.getLogger(__name__)
+
+CORPUS_DIR = Path(__file__).parent / "corpus"
+STREAM_ITEM = re.compile(r"<li class=\"js-stream-item[^>]*data-item-id=\"(\d+)\".*?</li>", re.DOTALL)
+PAGE_TEMPLATE = "<html><body><ol class=\"stream-items js-navigable-stream\">\n{}\n</ol></body></html>\n"
+MEDIA_SIZE = 64 * 1024
+
+PARSER = ArgumentParser(prog="bench")
+PARSER.add_argument("--repeat", type=int, default=3, help="Run every benchmark this many times, best result is reported")
+PARSER.add_argument("--output", type=Path, help="Also write results to this file")
+PARSER.add_argument("--baseline", type=Path, help="Results of an earlier run to compare against")
+PARSER.add_argument("--threshold", type=float, default=0.25, help="Fail if throughput is lower than baseline by more than this fraction")
+PARSER.add_argument("--html-parser", choices=tweetarchiver.HTML_PARSERS, default="html.parser")
+
+
+def load_corpus() -> Tuple[List[str], Dict[int, str]]:
+    """Return search pages and card frames (by tweet id) from the corpus."""
+    pages = [path.read_text(encoding="utf-8") for path in sorted((CORPUS_DIR / "search").glob("*.html"))]
+    frames = {int(path.stem): path.read_text(encoding="utf-8") for path in (CORPUS_DIR / "cards").glob("*.html")}
+    return pages, frames
+
+
+class StandIn(BaseAdapter):
+    """Transport adapter answering requests made through TWITTER_SESSION:
+    searches are served from the corpus tweets (since_id and max_id are
+    honored, 20 tweets per page), card frames from the corpus, t.co links
+    are redirected and media files are generated. Safe to use from multiple threads.
+    """
+    def __init__(self, pages: List[str], frames: Dict[int, str]) -> None:
+        super().__init__()
+        self.tweets = sorted(((int(item.group(1)), item.group(0)) for page in pages
+                              for item in STREAM_ITEM.finditer(page)), reverse=True)
+        self.frames = frames
+
+
+    def respond(self, request: requests.PreparedRequest) -> Tuple[int, dict, bytes]:
+        url = urlparse(request.url)
+        if url.netloc == "twitter.com" and url.path == "/search":
+            query = parse_qs(url.query)["q"][0]
+            operators = dict(term.split(":", maxsplit=1) for term in query.split() if ":" in term)
+            since_id = int(operators.get("since_id", 0))
+            max_id = int(operators.get("max_id", 2**63))
+            items = [html for tweet_id, html in self.tweets if since_id < tweet_id <= max_id][:20]
+            return 200, {}, PAGE_TEMPLATE.format("\n".join(items)).encode()
+        if url.netloc == "twitter.com" and url.path.startswith("/i/cards/"):
+            frame = self.frames.get(int(url.path.rsplit("/", maxsplit=1)[-1]))
+            if frame:
+                return 200, {}, frame.encode()
+        if url.netloc == "t.co":
+            return 301, {"location": f"https://example.com{url.path}"}, b""
+        if url.netloc in ("pbs.twimg.com", "video.twimg.com"):
+            if url.path.endswith(":orig") and ".png" in url.path:
+                # exercises image variant negotiation
+                return 404, {}, b""
+            return 200, {}, (url.path.encode() * (MEDIA_SIZE // len(url.path) + 1))[:MEDIA_SIZE]
+
+        return 404, {}, b""
+
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        status_code, headers, body = self.respond(request)
+        response = requests.Response()
+        response.status_code = status_code
+        response.reason = "OK" if status_code < 400 else "Not Found"
+        response.headers.update(headers)
+        response.headers["content-length"] = str(len(body))
+        response.raw = io.BytesIO(b"" if request.method == "HEAD" else body)
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+
+    def close(self) -> None:
+        pass
+
+
+def best_rate(function, repeat: int) -> float:
+    """Return the highest number of items per second out of repeat runs
+    of function, which returns (number of items, seconds elapsed).
+    """
+    rates = []
+    for _ in range(repeat):
+        count, elapsed = function()
+        rates.append(count / elapsed)
+    return max(rates)
+
+
+def bench_from_html(pages: List[str], repeat: int) -> Dict[str, float]:
+    tweets_html = [tweet for page in pages for tweet in tweetarchiver.make_soup(page).select(".js-stream-tweet")]
+
+    def parse_tweets() -> Tuple[int, float]:
+        start = time.perf_counter()
+        for tweet_html in tweets_html:
+            tweetarchiver.Tweet.from_html(tweet_html, resolve_cards=False)
+        return len(tweets_html), time.perf_counter() - start
+
+    def parse_attachments() -> Tuple[int, float]:
+        start = time.perf_counter()
+        for tweet_html in tweets_html:
+            tweetarchiver.Attachment.from_html(tweet_html)
+        return len(tweets_html), time.perf_counter() - start
+
+    return {
+        "tweet_from_html": best_rate(parse_tweets, repeat),
+        "attachment_from_html": best_rate(parse_attachments, repeat),
+    }
+
+
+def bench_scrape(repeat: int) -> Dict[str, float]:
+    def scrape() -> Tuple[int, float]:
+        start = time.perf_counter()
+        pages = sum(1 for _ in tweetarchiver.scrape_tweets("bench", close_session=False))
+        return pages, time.perf_counter() - start
+
+    return {"scrape_tweets": best_rate(scrape, repeat)}
+
+
+def bench_archive(repeat: int) -> Dict[str, float]:
+    """Time update_tweets and update_media on a fresh archive."""
+    tweet_rates = []
+    media_rates = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as archive_dir:
+            engine = tweetarchiver.create_archive_engine(Path(archive_dir) / "bench.sqlite")
+            tweetarchiver.migrate_schema(engine)
+            session = sessionmaker(bind=engine)()
+
+            start = time.perf_counter()
+            rows = cli.update_tweets("bench", session)
+            tweet_rates.append(rows / (time.perf_counter() - start))
+
+            start = time.perf_counter()
+            files = cli.update_media(session, Path(archive_dir))
+            media_rates.append(files / (time.perf_counter() - start))
+
+            session.close()
+            engine.dispose()
+
+    return {"update_tweets": max(tweet_rates), "update_media": max(media_rates)}
+
+
+UNITS = {
+    "tweet_from_html": "tweets/s",
+    "attachment_from_html": "tweets/s",
+    "scrape_tweets": "pages/s",
+    "update_tweets": "rows/s",
+    "update_media": "files/s",
+}
+
+
+def run(repeat: int = 3) -> dict:
+    """Run all benchmarks, return their results."""
+    pages, frames = load_corpus()
+    stand_in = StandIn(pages, frames)
+    tweetarchiver.TWITTER_SESSION.mount("https://", stand_in)
+    tweetarchiver.TWITTER_SESSION.mount("http://", stand_in)
+    # measure the code, not the rate limits
+    for name in tweetarchiver.RATE_LIMITER.buckets:
+        tweetarchiver.RATE_LIMITER.set_rate(name, 10**6)
+
+    results = {}
+    # progress messages of the scraping loop go to stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        results.update(bench_from_html(pages, repeat))
+        results.update(bench_scrape(repeat))
+        results.update(bench_archive(repeat))
+
+    return {
+        "version": tweetarchiver.__VERSION__,
+        "python": platform.python_version(),
+        "html_parser": tweetarchiver.HTML_PARSER,
+        "corpus": {"pages": len(pages), "tweets": len(stand_in.tweets), "card_frames": len(frames)},
+        "results": {name: {"value": round(value, 2), "unit": UNITS[name]} for name, value in results.items()},
+    }
+
+
+def regressions(report: dict, baseline: dict, threshold: float) -> List[str]:
+    """Return descriptions of results lower than baseline by more than threshold."""
+    regressed = []
+    for name, expected in baseline["results"].items():
+        result = report["results"].get(name)
+        if not result:
+            continue
+        change = result["value"] / expected["value"] - 1
+        if change < -threshold:
+            regressed.append(f"{name}: {result['value']} {result['unit']}, baseline {expected['value']} ({change:+.0%})")
+    return regressed
+
+
+def main() -> None:
+    args = PARSER.parse_args()
+    # corpus links do not match their cards, and missing image variants are logged as errors
+    tweetarchiver.TH.setLevel(logging.CRITICAL)
+    tweetarchiver.set_html_parser(args.html_parser)
+    report = run(args.repeat)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        args.output.write_text(output + "\n")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        regressed = regressions(report, baseline, args.threshold)
+        if regressed:
+            print("\n".join(regressed), file=sys.stderr)
+            raise SystemExit(f"Throughput of {len(regressed)} benchmarks regressed by more than {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Compare speed and output of available html parsers on tweets stored in an
+archive created with --store-html.
+
+usage: python -m tweetarchiver.tests.bench_parser path/to/archive.sqlite [--limit N]
+"""
+import time
+import logging
+from typing import List, Tuple
+from argparse import ArgumentParser
+
+from sqlalchemy.orm import sessionmaker
+
+import tweetarchiver
+from tweetarchiver import TweetHTML
+
+LOGGER = logging.getLogger(__name__)
+
+PARSER = ArgumentParser(prog="bench_parser")
+PARSER.add_argument("archive", help="Path to archive database containing stored tweet html")
+PARSER.add_argument("--limit", type=int, default=0, help="Only use this many tweets")
+PARSER.add_argument("--repeat", type=int, default=3, help="Parse the whole set this many times, best time is reported")
+
+
+def columns(row: tweetarchiver.DeclarativeBase) -> tuple:
+    return tuple(getattr(row, column.name) for column in row.__table__.columns if column.name != "id")
+
+
+def parse_all(tweets_html: List[str]) -> Tuple[float, list]:
+    """Parse tweets with currently selected parser.
+    Return time it took and the parsed rows.
+    """
+    results = []
+    start = time.perf_counter()
+    for html in tweets_html:
+        tweet_html = tweetarchiver.make_soup(html).select_one(".js-stream-tweet")
+        # card frames are not downloaded, only their urls are compared
+        tweet, attachments = tweetarchiver.parse_tweet(tweet_html, resolve_cards=False)
+        results.append((columns(tweet), tweet.pending_card, [columns(x) for x in attachments]))
+
+    return time.perf_counter() - start, results
+
+
+def benchmark(tweets_html: List[str], repeat: int = 3) -> bool:
+    """Print timings of every installed parser.
+    Return False if any parser produced different results than html.parser.
+    """
+    identical = True
+    reference = None
+    for parser in tweetarchiver.HTML_PARSERS:
+        try:
+            tweetarchiver.set_html_parser(parser)
+        except ValueError:
+            print(f"{parser:12}: not installed")
+            continue
+
+        elapsed = []
+        for _ in range(repeat):
+            run_time, results = parse_all(tweets_html)
+            elapsed.append(run_time)
+
+        if reference is None:
+            reference = results
+        mismatches = sum(1 for left, right in zip(reference, results) if left != right)
+        identical = identical and not mismatches
+        best = min(elapsed)
+        print(f"{parser:12}: {best:.3f}s, {len(tweets_html)/best:.1f} tweets/s, {mismatches} mismatches")
+
+    tweetarchiver.set_html_parser("html.parser")
+    return identical
+
+
+def main() -> None:
+    args = PARSER.parse_args()
+    engine = tweetarchiver.sqla.create_engine(f"sqlite:///{args.archive}")
+    session = sessionmaker(bind=engine)()
+    query = session.query(TweetHTML).order_by(TweetHTML.tweet_id)
+    if args.limit:
+        query = query.limit(args.limit)
+
+    tweets_html = [row.html for row in query]
+    session.close()
+    if not tweets_html:
+        raise RuntimeError("Archive does not contain any stored tweets, was it created with --store-html?")
+
+    print(f"Parsing {len(tweets_html)} tweets")
+    if not benchmark(tweets_html, args.repeat):
+        raise SystemExit("Parsers produced different results!")
+
+
+if __name__ == "__main__":
+    main()
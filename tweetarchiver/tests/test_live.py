@@ -1,7 +1,6 @@
 import logging
-from bs4 import BeautifulSoup as BS
 
-from tweetarchiver import Tweet, download, HTML_PARSER
+from tweetarchiver import Tweet, download, make_soup
 
 LOGGER = logging.getLogger(__name__)
 
@@ -76,7 +75,7 @@ def livetest():
             tweet_id = int(tweet_id)
             query_url = QUERY_TEMPLATE.format(user=user, since_id=tweet_id-1, max_id=tweet_id)
 
-            found_tweets = BS(download(query_url).response.text, HTML_PARSER)
+            found_tweets = make_soup(download(query_url).response.text)
             found_tweets = found_tweets.select(".js-stream-tweet")
             if not found_tweets:
                 LOGGER.error("Test query did not return any tweets (%s)", url)
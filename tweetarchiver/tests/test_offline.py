@@ -0,0 +1,236 @@
+import io
+import json
+import logging
+from hashlib import md5
+from pathlib import Path
+
+import requests
+from requests.adapters import BaseAdapter
+from sqlalchemy.orm import Session, sessionmaker
+
+import tweetarchiver
+from tweetarchiver import (Attachment, BulkWriter, HTMLDictionary, ScrapedRange, Tweet, TweetHTML,
+                           compress_html, decompress_html, download_resumable, parse_page)
+
+LOGGER = logging.getLogger(__name__)
+
+CORPUS_DIR = Path(__file__).parent / "corpus"
+
+
+def memory_session() -> Session:
+    engine = tweetarchiver.sqla.create_engine("sqlite://")
+    tweetarchiver.migrate_schema(engine)
+    return sessionmaker(bind=engine)()
+
+
+def corpus_tweets_html() -> list:
+    page = parse_page((CORPUS_DIR / "search" / "page_01.html").read_text(encoding="utf-8"), keep_html=True)
+    return [html for _, html in page.html]
+
+
+def test_bulk_writer_repeated_tweets():
+    """Tweets repeated within a batch are written once, with their attachments and html."""
+    page = parse_page((CORPUS_DIR / "search" / "page_01.html").read_text(encoding="utf-8"), keep_html=True)
+    tweets_html = [TweetHTML(html, 0, tweet_id).to_record() for tweet_id, html in page.html]
+    assert page.attachments
+
+    session = memory_session()
+    writer = BulkWriter(session, compress=False)
+    writer.add(page.tweets, page.attachments, tweets_html)
+    writer.add(page.tweets, page.attachments, tweets_html)
+    writer.flush()
+
+    assert session.query(Tweet).count() == len(page.tweets)
+    assert session.query(Attachment).count() == len(page.attachments)
+    assert session.query(TweetHTML).count() == len(page.tweets)
+    assert writer.attachment_rows == len(page.attachments)
+    assert writer.skipped_rows == len(page.tweets)
+
+
+def test_html_compression_round_trip():
+    """Html survives compression with and without a preset dictionary,
+    dictionaries are loaded from the archive when not in memory.
+    """
+    samples = corpus_tweets_html()
+    session = memory_session()
+    dictionary = HTMLDictionary.create(session, samples)
+    session.commit()
+
+    for html in samples:
+        plain = compress_html(html)
+        assert decompress_html(plain) == html
+
+        compressed = compress_html(html, dictionary)
+        assert len(compressed) < len(plain)
+        tweetarchiver.HTML_DICTIONARIES.pop(dictionary.digest, None)
+        assert decompress_html(compressed, session) == html
+
+
+def test_uncompressed_html_rows():
+    """Rows stored before html was compressed are read as they are."""
+    html = corpus_tweets_html()[0]
+    session = memory_session()
+    session.execute(TweetHTML.__table__.insert(), {"tweet_id": 1, "html": html, "scraped_on": 0})
+    session.commit()
+
+    assert session.query(TweetHTML).get(1).html == html
+    assert decompress_html(html) == html
+
+
+def scraped_ranges(session: Session) -> list:
+    return [(row.min_id, row.max_id) for row in session.query(ScrapedRange).order_by(ScrapedRange.min_id)]
+
+
+def test_scraped_range_merging():
+    """Overlapping and touching ranges are merged, separate ones are kept apart."""
+    session = memory_session()
+    ScrapedRange.add(session, 100, 200)
+    ScrapedRange.add(session, 300, 400)
+    assert scraped_ranges(session) == [(100, 200), (300, 400)]
+
+    # touching on either side
+    ScrapedRange.add(session, 201, 250)
+    ScrapedRange.add(session, 50, 99)
+    assert scraped_ranges(session) == [(50, 250), (300, 400)]
+
+    # contained in an existing range
+    ScrapedRange.add(session, 120, 130)
+    assert scraped_ranges(session) == [(50, 250), (300, 400)]
+
+    # overlapping both, bridging the gap
+    ScrapedRange.add(session, 240, 310)
+    assert scraped_ranges(session) == [(50, 400)]
+
+
+def test_scraped_range_gaps():
+    """Gaps are returned newest first, including open ends of the range."""
+    session = memory_session()
+    assert ScrapedRange.gaps(session, 0, 1000) == [(0, 1000)]
+
+    ScrapedRange.add(session, 100, 200)
+    ScrapedRange.add(session, 300, 400)
+    assert ScrapedRange.gaps(session, 0, 1000) == [(401, 1000), (201, 299), (0, 99)]
+    # bounds falling inside scraped ranges
+    assert ScrapedRange.gaps(session, 150, 350) == [(201, 299)]
+    assert ScrapedRange.gaps(session, 100, 400) == [(201, 299)]
+    assert ScrapedRange.gaps(session, 120, 180) == []
+
+    ScrapedRange.add(session, 201, 299)
+    assert ScrapedRange.gaps(session, 0, 1000) == [(401, 1000), (0, 99)]
+
+
+class CutStream(io.BytesIO):
+    """Response body which breaks off after cut_at bytes."""
+    def __init__(self, data: bytes, cut_at: int) -> None:
+        super().__init__(data)
+        self.cut_at = cut_at
+
+
+    def read(self, size: int = -1) -> bytes:
+        if self.tell() >= self.cut_at:
+            if self.cut_at < len(self.getbuffer()):
+                raise requests.ConnectionError("Connection dropped")
+            return b""
+        if size < 0 or self.tell() + size > self.cut_at:
+            size = self.cut_at - self.tell()
+        return super().read(size)
+
+
+class FileServer(BaseAdapter):
+    """Serve a single file, honoring Range and If-Range if honor_range is set.
+    The next full or partial response is cut after cut_at bytes of its body.
+    """
+    ETAG = "\"v1\""
+
+    def __init__(self, content: bytes) -> None:
+        super().__init__()
+        self.content = content
+        self.honor_range = True
+        self.cut_at = None
+        self.requests = []
+
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        self.requests.append(dict(request.headers))
+        status_code, body = 200, self.content
+        headers = {"etag": self.ETAG}
+        range_header = request.headers.get("Range")
+        if range_header and self.honor_range and request.headers.get("If-Range", self.ETAG) == self.ETAG:
+            start = int(range_header[len("bytes="):-1])
+            status_code, body = 206, self.content[start:]
+            headers["content-range"] = f"bytes {start}-{len(self.content) - 1}/{len(self.content)}"
+        headers["content-length"] = str(len(body))
+
+        response = requests.Response()
+        response.status_code = status_code
+        response.reason = "OK"
+        response.headers.update(headers)
+        response.raw = CutStream(body, len(body) if self.cut_at is None else self.cut_at)
+        response.url = request.url
+        response.request = request
+        self.cut_at = None
+        return response
+
+
+    def close(self) -> None:
+        pass
+
+
+def serve_file(content: bytes) -> FileServer:
+    server = FileServer(content)
+    tweetarchiver.TWITTER_SESSION.mount("https://files.example/", server)
+    return server
+
+
+def stop_serving() -> None:
+    tweetarchiver.TWITTER_SESSION.adapters.pop("https://files.example/", None)
+
+
+def test_download_resumable(tmp_path):
+    """Transfers cut mid-file are resumed with a range request, also by a later
+    call. Servers ignoring the range cause a clean restart.
+    """
+    content = bytes(range(256)) * 1000
+    url = "https://files.example/file.bin"
+    path = tmp_path / "file.bin"
+    server = serve_file(content)
+    try:
+        # resumed within the same call
+        server.cut_at = 100000
+        response = download_resumable(url, path)
+        assert response.hash == md5(content).hexdigest()
+        assert response.size == len(content)
+        assert path.read_bytes() == content
+        assert server.requests[1]["Range"] == "bytes=100000-"
+        assert server.requests[1]["If-Range"] == FileServer.ETAG
+        assert not tweetarchiver.PartialDownload.progress(path)
+
+        # resumed by the next call
+        path.unlink()
+        server.requests.clear()
+        server.cut_at = 50000
+        try:
+            download_resumable(url, path, max_attempts=1)
+        except requests.ConnectionError:
+            pass
+        else:
+            raise AssertionError("Interrupted transfer was not reported")
+        assert path.stat().st_size == 50000
+        assert tweetarchiver.PartialDownload.progress(path)["url"] == url
+
+        response = download_resumable(url, path)
+        assert server.requests[-1]["Range"] == "bytes=50000-"
+        assert response.hash == md5(content).hexdigest()
+        assert path.read_bytes() == content
+
+        # range not honored, partial file is replaced
+        path.write_bytes(b"x" * 1000)
+        Path(f"{path}.progress").write_text(json.dumps({"url": url, "validator": FileServer.ETAG, "length": None}))
+        server.honor_range = False
+        response = download_resumable(url, path)
+        assert server.requests[-1]["Range"] == "bytes=1000-"
+        assert response.hash == md5(content).hexdigest()
+        assert path.read_bytes() == content
+        assert not tweetarchiver.PartialDownload.progress(path)
+    finally:
+        stop_serving()